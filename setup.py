@@ -40,5 +40,9 @@ setup(
         'wcpan.telegram',
     ],
 
-    install_requires=['tornado >= 4'],
+    install_requires=['tornado >= 5'],
+    extras_require={
+        # faster JSON encoding and decoding
+        'orjson': ['orjson'],
+    },
 )
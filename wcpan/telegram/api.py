@@ -1,12 +1,72 @@
-import json
-from typing import List, Awaitable, Union
+import copy
+import os
+import os.path as op
+import time
+from typing import BinaryIO, Callable, List, Awaitable, Optional, Union
 
-from tornado import httpclient as thc, web as tw, httputil as thu
+from tornado import (concurrent as tc, gen as tg, httpclient as thc,
+                     ioloop as ti, web as tw, httputil as thu)
 
-from . import types, util
+from . import codec, types, util
+from .cache import ResponseCache
+from .dispatch import UpdateDispatcher
+from .offset import OffsetStore, OffsetTracker
+from .retry import RetryPolicy
+from .throttle import RateLimiter, PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+from .transport import Transport
+from .upload import UploadCache, get_digest
 
 
 _API_TEMPLATE = 'https://api.telegram.org/bot{api_token}/{api_method}'
+_FILE_TEMPLATE = 'https://api.telegram.org/file/bot{api_token}/{file_path}'
+# extra seconds to wait for a long poll beyond its server-side timeout
+_POLL_TIMEOUT_MARGIN = 10.0
+# a stalled download must not hold its connection forever
+_DOWNLOAD_TIMEOUT = 600.0
+# methods which count towards the flood limits of a chat
+_THROTTLED_METHODS = frozenset([
+    'sendMessage',
+    'forwardMessage',
+    'sendPhoto',
+    'sendAudio',
+    'sendDocument',
+    'sendVideo',
+    'sendVoice',
+    'sendVideoNote',
+    'sendLocation',
+    'sendVenue',
+    'sendContact',
+    'sendSticker',
+    'sendGame',
+    'editMessageText',
+    'editMessageCaption',
+    'editMessageReplyMarkup',
+])
+# methods without side effects, identical concurrent calls share one request
+_READ_METHODS = frozenset([
+    'getMe',
+    'getWebhookInfo',
+    'getUserProfilePhotos',
+    'getFile',
+    'getChat',
+    'getChatAdministrators',
+    'getChatMembersCount',
+    'getChatMember',
+    'getStickerSet',
+    'getGameHighScores',
+])
+# errors for file ids the server no longer accepts
+_BAD_FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file id',
+    'file_id_invalid',
+    'file reference expired',
+)
+# somebody is waiting for these, e.g. the spinner of a callback button
+_METHOD_PRIORITIES = {
+    'answerCallbackQuery': PRIORITY_INTERACTIVE,
+    'answerInlineQuery': PRIORITY_INTERACTIVE,
+}
 
 
 ReplyMarkup = Union[
@@ -14,15 +74,94 @@ ReplyMarkup = Union[
     types.ReplyKeyboardMarkup,
     types.ReplyKeyboardRemove,
     types.ForceReply,
+    types.FrozenMarkup,
 ]
 
 
 class BotClient(object):
 
-    def __init__(self, api_token: str) -> None:
+    def __init__(self, api_token: str, transport: Transport = None,
+                 poll_transport: Transport = None,
+                 download_transport: Transport = None,
+                 retry_policy: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None,
+                 cache: ResponseCache = None,
+                 upload_cache: UploadCache = None) -> None:
         self._api_token = api_token
         if not self._api_token:
             raise BotError('invalid API token')
+        self._transport = Transport() if transport is None else transport
+        # long polls hold their connection for the whole timeout, keep them
+        # away from the pool used by outgoing requests
+        if poll_transport is None:
+            poll_transport = Transport(max_clients=1)
+        self._poll_transport = poll_transport
+        # so are downloads of large files
+        if download_transport is None:
+            download_transport = Transport(max_clients=4,
+                                           request_timeout=_DOWNLOAD_TIMEOUT)
+        self._download_transport = download_transport
+        self._retry_policy = retry_policy
+        self._retry_policies = {}
+        self._rate_limiter = RateLimiter() if rate_limiter is None else rate_limiter
+        self._cache = cache
+        self._upload_cache = upload_cache
+        self._priority = None
+        # shared by clients from with_priority
+        self._inflight = {}
+
+    async def __aenter__(self) -> 'BotClient':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    @property
+    def transport(self) -> Transport:
+        return self._transport
+
+    @property
+    def poll_transport(self) -> Transport:
+        return self._poll_transport
+
+    @property
+    def download_transport(self) -> Transport:
+        return self._download_transport
+
+    @property
+    def cache(self) -> Optional[ResponseCache]:
+        return self._cache
+
+    @property
+    def stats(self) -> dict:
+        stats = {
+            'send': self._transport.stats,
+            'poll': self._poll_transport.stats,
+            'download': self._download_transport.stats,
+            'rate_limiter': self._rate_limiter.stats,
+        }
+        if self._cache is not None:
+            stats['cache'] = self._cache.stats
+        return stats
+
+    async def close(self) -> None:
+        self._transport.close()
+        self._poll_transport.close()
+        self._download_transport.close()
+
+    def with_priority(self, priority: int) -> 'BotClient':
+        """
+        Returns a client which sends every call with ``priority``. It shares
+        the connections and the rate limits with this client.
+        """
+        client = copy.copy(self)
+        client._priority = priority
+        return client
+
+    def set_retry_policy(self, api_method: str,
+                         retry_policy: Optional[RetryPolicy]) -> None:
+        # overrides the default policy for one method, None disables retry
+        self._retry_policies[api_method] = retry_policy
 
     async def get_updates(self, offset: int = None, limit: int = None,
                           timeout: int = None, allowed_updates: List[str] = None
@@ -37,7 +176,12 @@ class BotClient(object):
         if allowed_updates is not None:
             args['allowed_updates'] = allowed_updates
 
-        data = await self._get('getUpdates', args)
+        request_timeout = None
+        if timeout:
+            request_timeout = timeout + _POLL_TIMEOUT_MARGIN
+        data = await self._call('getUpdates', args,
+                                transport=self._poll_transport,
+                                request_timeout=request_timeout)
         return [types.Update(u) for u in data]
 
     async def set_webhook(self, url: str, certificate: types.InputFile = None,
@@ -56,20 +200,20 @@ class BotClient(object):
         if isinstance(certificate, types.InputFile):
             data = await self._post('setWebhook', args)
         else:
-            data = await self._get('setWebhook', args)
+            data = await self._call('setWebhook', args)
 
         return data
 
     async def delete_webhook(self) -> Awaitable[bool]:
-        data = await self._get('deleteWebhook')
+        data = await self._call('deleteWebhook')
         return data
 
     async def get_webhook_info(self) -> Awaitable[types.WebhookInfo]:
-        data = await self._get('getWebhookInfo')
+        data = await self._call('getWebhookInfo')
         return types.WebhookInfo(data)
 
     async def get_me(self) -> Awaitable[types.User]:
-        data = await self._get('getMe')
+        data = await self._call('getMe')
         return types.User(data)
 
     async def send_message(self, chat_id: Union[int, str], text: str,
@@ -94,7 +238,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('sendMessage', args)
+        data = await self._call('sendMessage', args)
         return types.Message(data)
 
     async def forward_message(self, chat_id: Union[int, str],
@@ -109,7 +253,7 @@ class BotClient(object):
         if disable_notification is not None:
             args['disable_notification'] = disable_notification
 
-        data = await self._get('forwardMessage', args)
+        data = await self._call('forwardMessage', args)
         return types.Message(data)
 
     async def send_photo(self, chat_id: Union[int, str],
@@ -131,12 +275,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(photo, str):
-            data = await self._get('sendPhoto', args)
-        else:
-            data = await self._post('sendPhoto', args)
-
-        return types.Message(data)
+        return await self._send_media('sendPhoto', 'photo', args)
 
     async def send_audio(self, chat_id: Union[int, str],
                          audio: Union[types.InputFile, str],
@@ -165,12 +304,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(audio, str):
-            data = await self._get('sendAudio', args)
-        else:
-            data = await self._post('sendAudio', args)
-
-        return types.Message(data)
+        return await self._send_media('sendAudio', 'audio', args)
 
     async def send_document(self, chat_id: Union[int, str],
                             document: Union[types.InputFile, str],
@@ -192,12 +326,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(document, str):
-            data = await self._get('sendDocument', args)
-        else:
-            data = await self._post('sendDocument', args)
-
-        return types.Message(data)
+        return await self._send_media('sendDocument', 'document', args)
 
     async def send_video(self, chat_id: Union[int, str],
                          video: Union[types.InputFile, str],
@@ -226,12 +355,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(video, str):
-            data = await self._get('sendVideo', args)
-        else:
-            data = await self._post('sendVideo', args)
-
-        return types.Message(data)
+        return await self._send_media('sendVideo', 'video', args)
 
     async def send_voice(self, chat_id: Union[int, str],
                          voice: Union[types.InputFile, str],
@@ -255,12 +379,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(voice, str):
-            data = await self._get('sendVoice', args)
-        else:
-            data = await self._post('sendVoice', args)
-
-        return types.Message(data)
+        return await self._send_media('sendVoice', 'voice', args)
 
     async def send_video_note(self, chat_id: Union[int, str],
                               video_note: Union[types.InputFile, str],
@@ -284,12 +403,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(video_note, str):
-            data = await self._get('sendVideoNote', args)
-        else:
-            data = await self._post('sendVideoNote', args)
-
-        return types.Message(data)
+        return await self._send_media('sendVideoNote', 'video_note', args)
 
     async def send_location(self, chat_id: Union[int, str], latitude: float,
                             longitude: float, disable_notification: bool = None,
@@ -308,7 +422,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('sendLocation', args)
+        data = await self._call('sendLocation', args)
         return types.Message(data)
 
     async def send_venue(self, chat_id: Union[int, str], latitude: float,
@@ -334,7 +448,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('sendVenue', args)
+        data = await self._call('sendVenue', args)
         return types.Message(data)
 
     async def send_contact(self, chat_id: Union[int, str], phone_number: str,
@@ -357,7 +471,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('sendContact', args)
+        data = await self._call('sendContact', args)
         return types.Message(data)
 
     async def send_chat_action(self, chat_id: Union[int, str],
@@ -367,7 +481,7 @@ class BotClient(object):
             'action': action,
         }
 
-        data = await self._get('sendChatAction', args)
+        data = await self._call('sendChatAction', args)
         return data
 
     async def get_user_profile_photos(self, user_id: int, offset: int = None,
@@ -381,7 +495,7 @@ class BotClient(object):
         if limit is not None:
             args['limit'] = limit
 
-        data = await self._get('getUserProfilePhotos', args)
+        data = await self._call('getUserProfilePhotos', args)
         return types.UserProfilePhotos(data)
 
     async def get_file(self, file_id: str) -> Awaitable[types.File]:
@@ -389,9 +503,53 @@ class BotClient(object):
             'file_id': file_id,
         }
 
-        data = await self._get('getFile', args)
+        data = await self._call('getFile', args)
         return types.File(data)
 
+    async def download_file(self, file: Union[types.File, str],
+                            destination: Union[str, BinaryIO] = None,
+                            offset: int = 0, max_size: int = None,
+                            streaming_callback: Callable[[bytes], None] = None
+                            ) -> Awaitable[int]:
+        """
+        Downloads a file chunk by chunk into ``destination``, a path or a
+        binary file object, or passes the chunks to ``streaming_callback``.
+
+        ``file`` is a ``types.File`` or a file id. A non-zero ``offset``
+        resumes a previous download from that byte, a path must hold at
+        least that many bytes and is truncated to it first. Files larger than
+        ``max_size`` bytes are not saved. Returns the number of bytes
+        received.
+        """
+        if (destination is None) == (streaming_callback is None):
+            raise BotError('needs either a destination or a streaming_callback')
+        if isinstance(file, str):
+            file = await self.get_file(file)
+        if file.file_path is None:
+            raise BotError('the file is not available for download')
+        if max_size is not None and file.file_size is not None:
+            if file.file_size > max_size:
+                raise BotError('file is too large')
+
+        fout = None
+        if isinstance(destination, str):
+            fout = _open_for_resume(destination, offset)
+            streaming_callback = fout.write
+        elif destination is not None:
+            streaming_callback = destination.write
+        try:
+            return await self._download(file.file_path, offset, max_size,
+                                        streaming_callback)
+        except BotError:
+            # the file is too large, do not leave a partial copy behind
+            if fout is not None and not offset:
+                fout.close()
+                os.remove(destination)
+            raise
+        finally:
+            if fout is not None:
+                fout.close()
+
     async def kick_chat_member(self, chat_id: Union[int, str],
                                user_id: int) -> Awaitable[bool]:
         args = {
@@ -399,7 +557,7 @@ class BotClient(object):
             'user_id': user_id,
         }
 
-        data = await self._get('kickChatMember', args)
+        data = await self._call('kickChatMember', args)
         return data
 
     async def leave_chat(self, chat_id: Union[int, str]) -> Awaitable[bool]:
@@ -407,7 +565,7 @@ class BotClient(object):
             'chat_id': chat_id,
         }
 
-        data = await self._get('leaveChat', args)
+        data = await self._call('leaveChat', args)
         return data
 
     async def unban_chat_member(self, chat_id: Union[int, str],
@@ -417,7 +575,7 @@ class BotClient(object):
             'user_id': user_id,
         }
 
-        data = await self._get('unbanChatMember', args)
+        data = await self._call('unbanChatMember', args)
         return data
 
     async def get_chat(self, chat_id: Union[int, str]) -> Awaitable[types.Chat]:
@@ -425,7 +583,7 @@ class BotClient(object):
             'chat_id': chat_id,
         }
 
-        data = await self._get('getChat', args)
+        data = await self._call('getChat', args)
         return types.Chat(data)
 
     async def get_chat_administrators(self, chat_id: Union[int, str]
@@ -434,7 +592,7 @@ class BotClient(object):
             'chat_id': chat_id,
         }
 
-        data = await self._get('getChatAdministrators', args)
+        data = await self._call('getChatAdministrators', args)
         return [types.ChatMember(_) for _ in data]
 
     async def get_chat_members_count(self, chat_id: Union[int, str]) -> Awaitable[int]:
@@ -442,7 +600,7 @@ class BotClient(object):
             'chat_id': chat_id,
         }
 
-        data = await self._get('getChatMembersCount', args)
+        data = await self._call('getChatMembersCount', args)
         return data
 
     async def get_chat_member(self, chat_id: Union[int, str],
@@ -452,7 +610,7 @@ class BotClient(object):
             'user_id': user_id,
         }
 
-        data = await self._get('getChatMember', args)
+        data = await self._call('getChatMember', args)
         return types.ChatMember(data)
 
     async def answer_callback_query(self, callback_query_id: str,
@@ -471,7 +629,7 @@ class BotClient(object):
         if cache_time is not None:
             args['cache_time'] = cache_time
 
-        data = await self._get('answerCallbackQuery', args)
+        data = await self._call('answerCallbackQuery', args)
         return data
 
     async def edit_message_text(self, text: str,
@@ -498,7 +656,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('editMessageText', args)
+        data = await self._call('editMessageText', args)
         if isinstance(data, bool):
             return data
         return types.Message(data)
@@ -522,7 +680,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('editMessageCaption', args)
+        data = await self._call('editMessageCaption', args)
         if isinstance(data, bool):
             return data
         return types.Message(data)
@@ -544,7 +702,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('editMessageReplyMarkup', args)
+        data = await self._call('editMessageReplyMarkup', args)
         if isinstance(data, bool):
             return data
         return types.Message(data)
@@ -555,7 +713,7 @@ class BotClient(object):
             'chat_id': chat_id,
             'message_id': message_id,
         }
-        data = await self._get('deleteMessage', args)
+        data = await self._call('deleteMessage', args)
         return data
 
     async def send_sticker(self, chat_id: Union[int, str],
@@ -575,18 +733,13 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        if isinstance(sticker, str):
-            data = await self._get('sendSticker', args)
-        else:
-            data = await self._post('sendSticker', args)
-
-        return types.Message(data)
+        return await self._send_media('sendSticker', 'sticker', args)
 
     async def get_sticker_set(self, name: str) -> Awaitable[types.StickerSet]:
         args = {
             'name': name,
         }
-        data = await self._get('getStickerSet', args)
+        data = await self._call('getStickerSet', args)
         return types.StickerSet(data)
 
     async def upload_sticker_file(self, user_id: int,
@@ -617,7 +770,7 @@ class BotClient(object):
             args['mask_position'] = mask_position
 
         if isinstance(png_sticker, str):
-            data = await self._get('createNewStickerSet', args)
+            data = await self._call('createNewStickerSet', args)
         else:
             data = await self._post('createNewStickerSet', args)
 
@@ -638,7 +791,7 @@ class BotClient(object):
             args['mask_position'] = mask_position
 
         if isinstance(png_sticker, str):
-            data = await self._get('addStickerToSet', args)
+            data = await self._call('addStickerToSet', args)
         else:
             data = await self._post('addStickerToSet', args)
 
@@ -650,14 +803,14 @@ class BotClient(object):
             'sticker': sticker,
             'position': position,
         }
-        data = await self._get('setStickerPositionInSet', args)
+        data = await self._call('setStickerPositionInSet', args)
         return data
 
     async def delete_sticker_from_set(self, sticker: str) -> Awaitable[bool]:
         args = {
             'sticker': sticker,
         }
-        data = await self._get('deleteStickerFromSet', args)
+        data = await self._call('deleteStickerFromSet', args)
         return data
 
     async def answer_inline_query(self, inline_query_id: str,
@@ -683,7 +836,7 @@ class BotClient(object):
         if switch_pm_parameter is not None:
             args['switch_pm_parameter'] = switch_pm_parameter
 
-        data = await self._post('answerInlineQuery', args)
+        data = await self._call('answerInlineQuery', args)
         return data
 
     async def send_game(self, chat_id: int, game_short_name: str,
@@ -702,7 +855,7 @@ class BotClient(object):
         if reply_markup is not None:
             args['reply_markup'] = reply_markup
 
-        data = await self._get('sendGame', args)
+        data = await self._call('sendGame', args)
         return types.Message(data)
 
     async def set_game_score(self, user_id: int, score: int, force: bool = None,
@@ -725,7 +878,7 @@ class BotClient(object):
         if inline_message_id is not None:
             args['inline_message_id'] = inline_message_id
 
-        data = await self._get('setGameScore', args)
+        data = await self._call('setGameScore', args)
         if isinstance(data, bool):
             return data
         return types.Message(data)
@@ -744,45 +897,316 @@ class BotClient(object):
         if inline_message_id is not None:
             args['inline_message_id'] = inline_message_id
 
-        data = await self._get('getGameHighScores', args)
+        data = await self._call('getGameHighScores', args)
         return [types.GameHighScore(_) for _ in data]
 
+    async def _download(self, file_path, offset, max_size, streaming_callback):
+        url = _FILE_TEMPLATE.format(api_token=self._api_token,
+                                    file_path=file_path)
+        download = _Download(offset, max_size, streaming_callback)
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+        request = thc.HTTPRequest(url, headers=headers,
+                                  header_callback=download.on_header,
+                                  streaming_callback=download.on_chunk)
+        try:
+            response = await self._download_transport.fetch(
+                request, raise_error=False, priority=self._get_priority(None))
+        except thc.HTTPError:
+            # the callbacks closed the connection
+            if download.error is not None:
+                raise download.error
+            raise
+        if download.error is not None:
+            raise download.error
+        # the offset is already at the end
+        if response.code == 416 and offset:
+            return 0
+        response.rethrow()
+        return download.received
+
     def _get_api_url(self, api_method):
         return _API_TEMPLATE.format(api_token=self._api_token,
                                     api_method=api_method)
 
     @staticmethod
     def _parse_response(response):
-        data = response.body.decode('utf-8')
-        data = json.loads(data)
+        try:
+            data = codec.loads(response.body)
+        except ValueError:
+            # not from the Bot API, e.g. a timeout or a proxy error
+            response.rethrow()
+            raise BotError('invalid response')
         if not data['ok']:
-            raise BotError(data['description'])
+            parameters = data.get('parameters', None)
+            if parameters is not None:
+                parameters = types.ResponseParameters(parameters)
+            raise BotError(data['description'], data.get('error_code', None),
+                           parameters)
         return data['result']
 
-    async def _get(self, api_method, args=None):
+    async def _call(self, api_method, args=None, transport=None,
+                    request_timeout=None):
+        # arguments go in a JSON body, so nested values need no extra
+        # encoding and long ones do not end up in the URL
         url = self._get_api_url(api_method)
-        if args is not None:
-            args = util.normalize_args(args)
-            url = thu.url_concat(url, args)
-
-        link = thc.AsyncHTTPClient()
-        request = thc.HTTPRequest(url)
-        response = await link.fetch(request)
-
-        return self._parse_response(response)
+        chat_id = None
+        if args is None:
+            args = {}
+        else:
+            chat_id = args.get('chat_id', None)
+        body = util.encode_json(args)
+
+        if transport is None:
+            transport = self._transport
+        priority = self._get_priority(api_method)
+
+        async def fetch(deadline):
+            await self._throttle(api_method, chat_id, priority, deadline)
+            request = thc.HTTPRequest(url, method='POST', headers={
+                'Content-Type': 'application/json',
+            }, body=body, request_timeout=request_timeout)
+            response = await transport.fetch(request, raise_error=False,
+                                             priority=priority,
+                                             deadline=deadline)
+            return self._parse_response(response)
+
+        if api_method in _READ_METHODS:
+            return await self._fetch_read(
+                api_method, chat_id, (api_method, body),
+                lambda: self._fetch_with_retry(api_method, fetch))
+        return await self._fetch_with_retry(api_method, fetch)
 
     async def _post(self, api_method, args):
         url = self._get_api_url(api_method)
+        chat_id = args.get('chat_id', None)
         args = util.normalize_args(args)
-        content_type, stream = util.generate_multipart_formdata(args.items())
-
-        link = thc.AsyncHTTPClient()
-        request = thc.HTTPRequest(url, method='POST', headers={
+        content_type, content_length, stream = util.generate_multipart_formdata(
+            args.items())
+        headers = {
             'Content-Type': content_type,
-        }, body_producer=stream, request_timeout=0.0)
-        response = await link.fetch(request)
+        }
+        # otherwise the body is sent in chunks
+        if content_length is not None:
+            headers['Content-Length'] = str(content_length)
+        priority = self._get_priority(api_method)
+
+        async def fetch(deadline):
+            await self._throttle(api_method, chat_id, priority, deadline)
+            request = thc.HTTPRequest(url, method='POST',
+                                      headers=dict(headers),
+                                      body_producer=stream,
+                                      request_timeout=0.0)
+            response = await self._transport.fetch(request, raise_error=False,
+                                                   priority=priority,
+                                                   deadline=deadline)
+            return self._parse_response(response)
+
+        return await self._fetch_with_retry(api_method, fetch)
+
+    async def _fetch_read(self, api_method, chat_id, key, fetch):
+        cache = self._cache
+        if cache is None or not cache.caches(api_method):
+            return await self._fetch_once(key, fetch)
+        hit, result = cache.get(key)
+        if hit:
+            return result
+        generation = cache.generation
+        result = await self._fetch_once(key, fetch)
+        cache.put(api_method, key, result, chat_id, generation)
+        return result
+
+    async def _fetch_once(self, key, fetch):
+        # every caller waits on its own future, so cancelling one of them
+        # does not cancel the others
+        future = tc.Future()
+        waiters = self._inflight.get(key, None)
+        if waiters is not None:
+            waiters.append(future)
+            return await future
+        self._inflight[key] = [future]
+        ti.IOLoop.current().spawn_callback(self._fetch_shared, key, fetch)
+        return await future
+
+    async def _fetch_shared(self, key, fetch):
+        result = None
+        error = None
+        try:
+            result = await fetch()
+        except Exception as e:
+            error = e
+        waiters = self._inflight.pop(key)
+        for future in waiters:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def _send_media(self, api_method, kind, args):
+        input_file = args[kind]
+        if isinstance(input_file, str):
+            data = await self._call(api_method, args)
+            return types.Message(data)
+        # hashing would consume a file which can only be read once
+        if self._upload_cache is None or not input_file.reusable:
+            data = await self._post(api_method, args)
+            return types.Message(data)
+
+        digest = await get_digest(input_file)
+        file_id = await self._upload_cache.get(kind, digest)
+        if file_id is not None:
+            cached_args = dict(args)
+            cached_args[kind] = file_id
+            try:
+                data = await self._call(api_method, cached_args)
+                return types.Message(data)
+            except BotError as e:
+                if not _is_bad_file_id(e):
+                    raise
+            # expired or from another bot, upload again
+            await self._upload_cache.discard(kind, digest)
+
+        data = await self._post(api_method, args)
+        file_id = _get_file_id(data, kind)
+        if file_id is not None:
+            await self._upload_cache.set(kind, digest, file_id)
+        return types.Message(data)
 
-        return self._parse_response(response)
+    def _get_priority(self, api_method):
+        if self._priority is not None:
+            return self._priority
+        return _METHOD_PRIORITIES.get(api_method, PRIORITY_NORMAL)
+
+    async def _throttle(self, api_method, chat_id, priority, deadline):
+        if api_method in _THROTTLED_METHODS:
+            await self._rate_limiter.acquire(chat_id, priority, deadline)
+
+    async def _fetch_with_retry(self, api_method, fetch):
+        policy = self._retry_policies.get(api_method, self._retry_policy)
+        if policy is None:
+            return await fetch(None)
+
+        started = time.monotonic()
+        # the rate limiter and the transport give up at the deadline, so a
+        # late request never goes out after the call has failed
+        deadline = None
+        if policy.deadline is not None:
+            deadline = started + policy.deadline
+        attempt = 0
+        while True:
+            try:
+                return await fetch(deadline)
+            except (BotError, thc.HTTPError) as e:
+                attempt += 1
+                delay = _get_retry_delay(policy, attempt, e)
+                elapsed = time.monotonic() - started
+                if delay is None or not policy.allows(attempt, elapsed + delay):
+                    raise
+            await tg.sleep(delay)
+
+
+def _get_retry_delay(policy, attempt, error):
+    if isinstance(error, BotError):
+        if error.retry_after is not None:
+            return policy.get_delay(attempt - 1, error.retry_after)
+        if error.error_code is not None and error.error_code >= 500:
+            return policy.get_delay(attempt - 1)
+        return None
+    # 599 means no response at all, e.g. network errors
+    if error.code >= 500:
+        return policy.get_delay(attempt - 1)
+    return None
+
+
+class _Download(object):
+
+    def __init__(self, offset, max_size, streaming_callback):
+        self._offset = offset
+        self._max_size = max_size
+        self._streaming_callback = streaming_callback
+        self._code = None
+        self._skip = 0
+        self.received = 0
+        self.error = None
+
+    def on_header(self, line):
+        # a new status line for every response, e.g. after a redirect
+        if line.startswith('HTTP/'):
+            self._code = thu.parse_response_start_line(line.strip()).code
+            # the server ignored the range, drop what we already have
+            self._skip = self._offset if self._code == 200 else 0
+            return
+        if self._code not in (200, 206) or self._max_size is None:
+            return
+        name, sep, value = line.partition(':')
+        if name.strip().lower() != 'content-length':
+            return
+        size = int(value) - self._skip + self._offset
+        if size > self._max_size:
+            self._abort()
+
+    def on_chunk(self, chunk):
+        # error pages also come in chunks
+        if self._code not in (200, 206):
+            return
+        if self._skip:
+            skipped = min(self._skip, len(chunk))
+            chunk = chunk[skipped:]
+            self._skip -= skipped
+        if not chunk:
+            return
+        if self._max_size is not None:
+            if self._offset + self.received + len(chunk) > self._max_size:
+                self._abort()
+        self._streaming_callback(chunk)
+        self.received += len(chunk)
+
+    def _abort(self):
+        # raising from a callback closes the connection, so the rest of the
+        # file is never read
+        self.error = BotError('file is too large')
+        raise _DownloadAborted('file is too large')
+
+
+class _DownloadAborted(thu.HTTPInputError):
+    # tornado closes the connection on input errors without logging them as
+    # uncaught exceptions
+    pass
+
+
+def _open_for_resume(path, offset):
+    if not offset:
+        return open(path, 'wb')
+    size = op.getsize(path) if op.exists(path) else 0
+    if size < offset:
+        raise BotError('cannot resume at {0}, only {1} bytes are saved'.format(
+            offset, size))
+    fout = open(path, 'r+b')
+    fout.truncate(offset)
+    fout.seek(offset)
+    return fout
+
+
+def _is_bad_file_id(error):
+    if error.error_code != 400:
+        return False
+    description = error.description.lower()
+    return any(_ in description for _ in _BAD_FILE_ID_ERRORS)
+
+
+def _get_file_id(data, kind):
+    # the server may store the file as another kind, e.g. a GIF document
+    # becomes an animation, then it has no file id for this kind
+    media = data.get(kind, None)
+    if isinstance(media, list):
+        # photos come in several sizes, the last one is the original
+        media = media[-1] if media else None
+    if not isinstance(media, dict):
+        return None
+    return media.get('file_id', None)
 
 
 class _DispatcherMixin(object):
@@ -856,58 +1280,64 @@ class _DispatcherMixin(object):
     async def on_pinned_message(self, message: types.Message) -> None:
         pass
 
+    @classmethod
+    def _get_message_table(cls):
+        # computed once per class, cls.__dict__ avoids reusing the table of
+        # a parent class
+        table = cls.__dict__.get('_message_table', None)
+        if table is None:
+            table = tuple((key, name if _is_overridden(cls, name) else None)
+                          for key, name in _MESSAGE_HANDLERS)
+            cls._message_table = table
+        return table
+
+    @classmethod
+    def _get_allowed_updates(cls):
+        # always a list, the server keeps its previous setting if it is
+        # missing, an empty list means every kind
+        if _is_overridden(cls, '_receive_update'):
+            # a custom router may handle anything
+            return []
+        return [kind for kind, names in _UPDATE_HANDLERS
+                if any(_is_overridden(cls, _) for _ in names)]
+
+    def _get_client(self) -> Optional[BotClient]:
+        return None
+
+    def _invalidate_cache(self, message, data):
+        client = self._get_client()
+        if client is None or client.cache is None:
+            return
+        if any(data.get(_, None) is not None for _ in _CHAT_CHANGES):
+            client.cache.invalidate(message.chat.id_)
+
     async def _receive_message(self, message: types.Message) -> None:
-        if message.text is not None:
-            await self.on_text(message)
-        elif message.audio is not None:
-            await self.on_audio(message)
-        elif message.document is not None:
-            await self.on_document(message)
-        elif message.game is not None:
-            await self.on_game(message)
-        elif message.photo is not None:
-            await self.on_photo(message)
-        elif message.sticker is not None:
-            await self.on_sticker(message)
-        elif message.video is not None:
-            await self.on_video(message)
-        elif message.voice is not None:
-            await self.on_voice(message)
-        elif message.video_note is not None:
-            await self.on_video_note(message)
-        elif message.caption is not None:
-            await self.on_caption(message)
-        elif message.contact is not None:
-            await self.on_contact(message)
-        elif message.location is not None:
-            await self.on_location(message)
-        elif message.venue is not None:
-            await self.on_venue(message)
-        elif message.new_chat_members is not None:
-            await self.on_new_chat_members(message)
-        elif message.left_chat_member is not None:
-            await self.on_left_chat_member(message)
-        elif message.new_chat_title is not None:
-            await self.on_new_chat_title(message)
-        elif message.new_chat_photo is not None:
-            await self.on_new_chat_photo(message)
-        elif message.delete_chat_photo is not None:
-            await self.on_delete_chat_photo(message)
-        elif message.group_chat_created is not None:
-            await self.on_group_chat_created(message)
-        elif message.supergroup_chat_created is not None:
-            await self.on_supergroup_chat_created(message)
-        elif message.channel_chat_created is not None:
-            await self.on_channel_chat_created(message)
-        elif message.pinned_message is not None:
-            await self.on_pinned_message(message)
-        else:
-            raise BotError('unknown message type')
+        data = message.to_dict()
+        self._invalidate_cache(message, data)
+        for key, name in self._get_message_table():
+            if data.get(key, None) is None:
+                continue
+            # the first matching kind owns the message, even if its handler
+            # is not implemented
+            if name is not None:
+                await getattr(self, name)(message)
+            return
+        raise BotError('unknown message type')
+
+    async def _receive_update(self, update: types.Update) -> None:
+        data = update.to_dict()
+        if 'message' in data:
+            await self._receive_message(update.message)
+        elif 'callback_query' in data:
+            await self._receive_callback_query(update.callback_query)
+        elif 'inline_query' in data:
+            await self._receive_inline_query(update.inline_query)
 
     async def _receive_callback_query(self, callback_query: types.CallbackQuery) -> None:
-        if callback_query.data is not None:
+        data = callback_query.to_dict()
+        if data.get('data', None) is not None:
             await self.on_callback_data(callback_query)
-        elif callback_query.game_short_name is not None:
+        elif data.get('game_short_name', None) is not None:
             await self.on_game_short_name(callback_query)
 
     async def on_callback_data(self, callback_query: types.CallbackQuery) -> None:
@@ -923,11 +1353,75 @@ class _DispatcherMixin(object):
         pass
 
 
+# message kinds in the order they are checked
+_MESSAGE_HANDLERS = (
+    ('text', 'on_text'),
+    ('audio', 'on_audio'),
+    ('document', 'on_document'),
+    ('game', 'on_game'),
+    ('photo', 'on_photo'),
+    ('sticker', 'on_sticker'),
+    ('video', 'on_video'),
+    ('voice', 'on_voice'),
+    ('video_note', 'on_video_note'),
+    ('caption', 'on_caption'),
+    ('contact', 'on_contact'),
+    ('location', 'on_location'),
+    ('venue', 'on_venue'),
+    ('new_chat_members', 'on_new_chat_members'),
+    ('left_chat_member', 'on_left_chat_member'),
+    ('new_chat_title', 'on_new_chat_title'),
+    ('new_chat_photo', 'on_new_chat_photo'),
+    ('delete_chat_photo', 'on_delete_chat_photo'),
+    ('group_chat_created', 'on_group_chat_created'),
+    ('supergroup_chat_created', 'on_supergroup_chat_created'),
+    ('channel_chat_created', 'on_channel_chat_created'),
+    ('pinned_message', 'on_pinned_message'),
+)
+
+
+# message kinds which change cached chat lookups
+_CHAT_CHANGES = (
+    'new_chat_members',
+    'left_chat_member',
+    'new_chat_title',
+    'new_chat_photo',
+    'delete_chat_photo',
+    'pinned_message',
+)
+
+
+# update kinds and the handlers which need them
+_UPDATE_HANDLERS = (
+    ('message', ('_receive_message',) +
+                tuple(name for kind, name in _MESSAGE_HANDLERS)),
+    ('callback_query', ('_receive_callback_query', 'on_callback_data',
+                        'on_game_short_name')),
+    ('inline_query', ('_receive_inline_query', 'on_inline_query')),
+)
+
+
+def _is_overridden(class_, name):
+    return getattr(class_, name) is not getattr(_DispatcherMixin, name)
+
+
 class BotAgent(_DispatcherMixin):
 
-    def __init__(self, api_token: str, *args, **kwargs) -> None:
+    def __init__(self, api_token: str, *args, transport: Transport = None,
+                 poll_transport: Transport = None,
+                 download_transport: Transport = None,
+                 retry_policy: RetryPolicy = None,
+                 rate_limiter: RateLimiter = None,
+                 cache: ResponseCache = None,
+                 upload_cache: UploadCache = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._api = BotClient(api_token)
+        self._api = BotClient(api_token, transport=transport,
+                              poll_transport=poll_transport,
+                              download_transport=download_transport,
+                              retry_policy=retry_policy,
+                              rate_limiter=rate_limiter, cache=cache,
+                              upload_cache=upload_cache)
+        self._offset = 0
 
     @property
     def client(self) -> BotClient:
@@ -935,14 +1429,13 @@ class BotAgent(_DispatcherMixin):
 
     async def get_updates(self,
                           timeout: int = 0) -> Awaitable[List[types.Update]]:
-        offset = 0
         updates = []
         while True:
-            us = await self._api.get_updates(offset, timeout=timeout)  # type: List[types.Update]
+            us = await self._api.get_updates(self._offset, timeout=timeout)  # type: List[types.Update]
             updates.extend(us)
             if not us:
                 break
-            offset = us[-1].update_id + 1
+            self._offset = us[-1].update_id + 1
         return updates
 
     async def get_user_profile_photos(self, user_id: int
@@ -962,52 +1455,128 @@ class BotAgent(_DispatcherMixin):
             'photos': photos,
         })
 
-    async def poll(self, timeout: int) -> Awaitable[None]:
-        # remove previous webhook first
-        ok = False
-        while not ok:
-            ok = await self._api.delete_webhook()
-        # forever
-        while True:
-            try:
-                updates = await self.get_updates(timeout)  # type: List[types.Update]
-                for update in updates:
-                    if update.message is not None:
-                        await self._receive_message(update.message)
-                    elif update.callback_query is not None:
-                        await self._receive_callback_query(update.callback_query)
-                    elif update.inline_query is not None:
-                        await self._receive_inline_query(update.inline_query)
-            except thc.HTTPError as e:
-                if e.code != 599:
-                    raise
-
-    async def listen(self, hook_url: str) -> Awaitable[None]:
-        await self._api.set_webhook(url=hook_url)
+    async def poll(self, timeout: int, dispatcher: UpdateDispatcher = None,
+                   offset_store: OffsetStore = None) -> Awaitable[None]:
+        if dispatcher is None:
+            dispatcher = UpdateDispatcher()
+        tracker = OffsetTracker(self._offset - 1, offset_store)
+        try:
+            # updates received but not handled before a restart
+            pending = await tracker.load()
+            receive = tracker.wrap(self._receive_update)
+            allowed_updates = self._get_allowed_updates()
+            # remove previous webhook first
+            ok = False
+            while not ok:
+                ok = await self._api.delete_webhook()
+            for update in pending:
+                await dispatcher.put(update, receive)
+            # forever
+            while True:
+                self._offset = tracker.queued + 1
+                updates = await self._fetch_updates(timeout, allowed_updates)  # type: List[types.Update]
+                fresh = [u for u in updates if tracker.add(u)]
+                # the next poll tells the server to forget them
+                await tracker.flush()
+                # waits when the dispatcher is full, so the backlog stays on
+                # the server instead of in memory
+                for update in fresh:
+                    await dispatcher.put(update, receive)
+        finally:
+            if offset_store is not None:
+                await offset_store.close()
+
+    async def _fetch_updates(self, timeout, allowed_updates):
+        try:
+            return await self._api.get_updates(
+                self._offset, timeout=timeout, allowed_updates=allowed_updates)
+        except thc.HTTPError as e:
+            if e.code != 599:
+                raise
+            return []
+
+    async def listen(self, hook_url: str,
+                     handler_class: type = None) -> Awaitable[None]:
+        # only ask for updates the webhook handler can handle
+        allowed_updates = []
+        if handler_class is not None:
+            allowed_updates = handler_class._get_allowed_updates()
+        await self._api.set_webhook(url=hook_url,
+                                    allowed_updates=allowed_updates)
 
     async def close(self):
         await self._api.delete_webhook()
+        await self._api.close()
+
+    def _get_client(self):
+        return self._api
 
 
 class BotHookHandler(tw.RequestHandler, _DispatcherMixin):
 
+    # defaults for subclasses which override initialize without calling it
+    _dispatcher = None  # type: Optional[UpdateDispatcher]
+    _client = None  # type: Optional[BotClient]
+    _reply = None  # type: Optional[dict]
+
+    def initialize(self, dispatcher: UpdateDispatcher = None,
+                   client: BotClient = None) -> None:
+        # with a dispatcher, the update is acknowledged as soon as it is
+        # queued, and handlers run after the response has been sent
+        self._dispatcher = dispatcher
+        # its cache is invalidated by updates about chat changes
+        self._client = client
+
+    def reply_with_method(self, api_method: str, args: dict) -> None:
+        """
+        Answers the update with one API call in the webhook response body,
+        which saves a request to the server. The result of the call is not
+        available.
+        """
+        if self._dispatcher is not None:
+            raise BotError('the webhook has been answered')
+        if self._reply is not None:
+            raise BotError('only one method can be sent in a webhook reply')
+        if any(isinstance(v, types.InputFile) for v in args.values()):
+            raise BotError('cannot upload files in a webhook reply')
+        reply = dict(args)
+        reply['method'] = api_method
+        self._reply = reply
+
     async def post(self):
-        data = self.request.body
-        data = data.decode('utf-8')
-        data = json.loads(data)
+        data = codec.loads(self.request.body)
         update = types.Update(data)
-        if update.message is not None:
-            await self._receive_message(update.message)
-        elif update.callback_query is not None:
-            await self._receive_callback_query(update.callback_query)
-        elif update.inline_query is not None:
-            await self._receive_inline_query(update.inline_query)
+        if self._dispatcher is not None:
+            await self._dispatcher.put(update, self._receive_update)
+            return
+
+        await self._receive_update(update)
+        if self._reply is not None:
+            self.set_header('Content-Type', 'application/json')
+            self.write(util.encode_json(self._reply))
+
+    def _get_client(self):
+        return self._client
 
 
 class BotError(Exception):
 
-    def __init__(self, description):
+    def __init__(self, description, error_code=None, parameters=None):
         self.description = description
+        self.error_code = error_code  # type: Optional[int]
+        self.parameters = parameters  # type: Optional[types.ResponseParameters]
 
     def __str__(self):
         return self.description
+
+    @property
+    def retry_after(self) -> Optional[int]:
+        if self.parameters is None:
+            return None
+        return self.parameters.retry_after
+
+    @property
+    def migrate_to_chat_id(self) -> Optional[int]:
+        if self.parameters is None:
+            return None
+        return self.parameters.migrate_to_chat_id
@@ -0,0 +1,157 @@
+import os
+import os.path as op
+from typing import Awaitable, Callable, Iterable, Union
+
+from tornado import gen as tg, locks as tl
+
+from . import codec, util
+from .api import BotClient, BotError
+from .throttle import PRIORITY_BULK
+
+
+SENT = 'sent'
+BLOCKED = 'blocked'
+MIGRATED = 'migrated'
+FAILED = 'failed'
+
+
+ChatId = Union[int, str]
+
+
+class Broadcast(object):
+    """
+    Sends the same message to many chats.
+
+    ``send`` is called as ``send(client, chat_id)`` for every chat, with a
+    client which sends at bulk priority, so interactive traffic still goes
+    first. The outcome of every chat is appended to ``checkpoint_path``, a
+    later run with the same path skips chats which were sent, blocked or
+    migrated, and tries failed ones again.
+    """
+
+    def __init__(self, client: BotClient, chat_ids: Iterable[ChatId],
+                 send: Callable[[BotClient, ChatId], Awaitable],
+                 checkpoint_path: str = None, max_concurrency: int = 30,
+                 max_attempts: int = 3, flush_every: int = 100) -> None:
+        self._client = client.with_priority(PRIORITY_BULK)
+        self._chat_ids = chat_ids
+        self._send = send
+        self._checkpoint_path = checkpoint_path
+        self._max_concurrency = max_concurrency
+        self._max_attempts = max_attempts
+        self._flush_every = flush_every
+        self._done = set()
+        self._counts = {
+            SENT: 0,
+            BLOCKED: 0,
+            MIGRATED: 0,
+            FAILED: 0,
+        }
+        self._records = []
+        self._lock = tl.Lock()
+
+    @property
+    def stats(self) -> dict:
+        return dict(self._counts)
+
+    async def run(self) -> Awaitable[dict]:
+        await self._load()
+        chat_ids = iter(self._chat_ids)
+        workers = [self._work(chat_ids) for _ in range(self._max_concurrency)]
+        try:
+            await tg.multi(workers)
+        finally:
+            await self._flush()
+        return self.stats
+
+    async def _work(self, chat_ids):
+        # all workers share one iterator
+        for chat_id in chat_ids:
+            if chat_id in self._done:
+                continue
+            record = await self._send_to(chat_id)
+            self._done.add(chat_id)
+            self._counts[record['outcome']] += 1
+            self._records.append(record)
+            if len(self._records) >= self._flush_every:
+                await self._flush()
+
+    async def _send_to(self, chat_id):
+        record = {
+            'chat_id': chat_id,
+        }
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                await self._send(self._client, chat_id)
+            except BotError as e:
+                migrated = 'new_chat_id' in record
+                if e.migrate_to_chat_id is not None and not migrated:
+                    # the group became a supergroup, send to the new one
+                    chat_id = e.migrate_to_chat_id
+                    record['new_chat_id'] = chat_id
+                    continue
+                if e.retry_after is not None and attempt < self._max_attempts:
+                    await tg.sleep(e.retry_after)
+                    continue
+                record['outcome'] = BLOCKED if e.error_code == 403 else FAILED
+                record['error'] = str(e)
+                return record
+            except Exception as e:
+                record['outcome'] = FAILED
+                record['error'] = str(e)
+                return record
+            record['outcome'] = MIGRATED if 'new_chat_id' in record else SENT
+            return record
+
+    async def _load(self):
+        if self._checkpoint_path is None:
+            return
+        records = await util.run_in_executor(_read_records,
+                                             self._checkpoint_path)
+        for record in records:
+            # e.g. network errors or flood control, worth another try
+            if record['outcome'] == FAILED:
+                continue
+            self._done.add(record['chat_id'])
+            self._counts[record['outcome']] += 1
+
+    async def _flush(self):
+        async with self._lock:
+            records = self._records
+            self._records = []
+            if not records or self._checkpoint_path is None:
+                return
+            await util.run_in_executor(_append_records,
+                                       self._checkpoint_path, records)
+
+
+def _read_records(path):
+    if not op.exists(path):
+        return []
+    with open(path, 'r+b') as fio:
+        data = fio.read()
+        # the last line may be cut by a crash, drop it so the next record
+        # starts on a new line
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            fio.truncate(end)
+            fio.flush()
+            os.fsync(fio.fileno())
+    records = []
+    for line in data[:end].splitlines():
+        try:
+            records.append(codec.loads(line))
+        except ValueError:
+            continue
+    return records
+
+
+def _append_records(path, records):
+    lines = b''.join(codec.dumps(_) + b'\n' for _ in records)
+    with open(path, 'ab') as fout:
+        fout.write(lines)
+        fout.flush()
+        os.fsync(fout.fileno())
+
@@ -0,0 +1,106 @@
+import collections
+import time
+from typing import Any, Dict, Hashable, Tuple, Union
+
+
+# seconds to keep results of each method
+_DEFAULT_TTLS = {
+    'getMe': 3600.0,
+    'getChat': 60.0,
+    'getChatAdministrators': 60.0,
+    'getChatMember': 30.0,
+    'getChatMembersCount': 60.0,
+    'getStickerSet': 3600.0,
+}
+
+
+class ResponseCache(object):
+    """
+    Keeps results of lookups which rarely change.
+
+    Results of each method live for its TTL in ``ttls``, which overrides the
+    defaults, a TTL of None disables caching that method. At most
+    ``max_size`` results are kept, the least recently used one goes first.
+    """
+
+    def __init__(self, max_size: int = 1024,
+                 ttls: Dict[str, float] = None) -> None:
+        self._max_size = max_size
+        self._ttls = dict(_DEFAULT_TTLS)
+        if ttls is not None:
+            self._ttls.update(ttls)
+        # key -> (expires, chat_id, value)
+        self._entries = collections.OrderedDict()
+        self._chats = {}
+        # changes on every invalidation, so results fetched before it are not
+        # stored after it
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+    def caches(self, api_method: str) -> bool:
+        return bool(self._ttls.get(api_method, None))
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self._misses += 1
+            return False, None
+        expires, chat_id, value = entry
+        if expires <= time.monotonic():
+            self._remove(key)
+            self._misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return True, value
+
+    def put(self, api_method: str, key: Hashable, value: Any,
+            chat_id: Union[int, str] = None, generation: int = None) -> None:
+        if generation is not None and generation != self._generation:
+            return
+        ttl = self._ttls.get(api_method, None)
+        if not ttl:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, chat_id, value)
+        if chat_id is not None:
+            self._chats.setdefault(chat_id, set()).add(key)
+        while len(self._entries) > self._max_size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, chat_id: Union[int, str] = None) -> None:
+        """
+        Drops results about ``chat_id``, or everything if it is None.
+        """
+        self._generation += 1
+        if chat_id is None:
+            self._entries.clear()
+            self._chats.clear()
+            return
+        for key in self._chats.pop(chat_id, ()):
+            del self._entries[key]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        chat_id = entry[1]
+        if chat_id is None:
+            return
+        keys = self._chats[chat_id]
+        keys.discard(key)
+        if not keys:
+            del self._chats[chat_id]
@@ -0,0 +1,169 @@
+import collections
+import time
+from typing import Awaitable, Union
+
+from tornado import concurrent as tc, ioloop as ti
+
+from . import types, util
+from .api import BotClient, BotError
+
+
+class EditCoalescer(object):
+    """
+    Merges rapid edits of the same message.
+
+    Only the latest requested state of a message is kept, and it is sent at
+    most once per ``interval`` seconds. A state equal to the last one sent
+    is not sent at all. Every call returns when the state which replaced it
+    has been sent or skipped.
+    """
+
+    def __init__(self, client: BotClient, interval: float = 1.0,
+                 max_messages: int = 1024) -> None:
+        self._client = client
+        self._interval = interval
+        self._max_messages = max_messages
+        self._messages = collections.OrderedDict()
+
+    async def edit_message_text(self, chat_id: Union[int, str],
+                                message_id: int, text: str,
+                                parse_mode: str = None,
+                                disable_web_page_preview: bool = None,
+                                reply_markup: types.InlineKeyboardMarkup = None
+                                ) -> Awaitable[None]:
+        state = self._get_state(chat_id, message_id)
+        # editing the text without a markup removes the keyboard
+        state.pending = {
+            'text': text,
+            'parse_mode': parse_mode,
+            'disable_web_page_preview': disable_web_page_preview,
+            'reply_markup': reply_markup,
+        }
+        await self._schedule(state)
+
+    async def edit_message_reply_markup(self, chat_id: Union[int, str],
+                                        message_id: int,
+                                        reply_markup:
+                                            types.InlineKeyboardMarkup = None
+                                        ) -> Awaitable[None]:
+        state = self._get_state(chat_id, message_id)
+        if state.pending is None:
+            state.pending = {}
+        # keeps a pending text edit, with the new markup
+        state.pending['reply_markup'] = reply_markup
+        await self._schedule(state)
+
+    def _get_state(self, chat_id, message_id):
+        key = (chat_id, message_id)
+        state = self._messages.get(key, None)
+        if state is None:
+            state = _MessageState(chat_id, message_id)
+            self._messages[key] = state
+            self._evict()
+        else:
+            self._messages.move_to_end(key)
+        return state
+
+    def _evict(self):
+        # forget idle messages, the oldest first
+        for key in list(self._messages.keys()):
+            if len(self._messages) <= self._max_messages:
+                break
+            if self._messages[key].idle:
+                del self._messages[key]
+
+    def _schedule(self, state):
+        future = tc.Future()
+        state.waiters.append(future)
+        if state.timer is None and not state.sending:
+            delay = state.sent_at + self._interval - time.monotonic()
+            state.timer = ti.IOLoop.current().call_later(
+                max(delay, 0), self._flush, state)
+        return future
+
+    def _flush(self, state):
+        state.timer = None
+        ti.IOLoop.current().spawn_callback(self._send, state)
+
+    async def _send(self, state):
+        pending = state.pending
+        waiters = state.waiters
+        state.pending = None
+        state.waiters = []
+
+        state.sending = True
+        error = None
+        try:
+            await self._send_pending(state, pending)
+        except Exception as e:
+            error = e
+        finally:
+            state.sending = False
+
+        for future in waiters:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+        # edits which came in while sending
+        if state.waiters and state.timer is None:
+            state.timer = ti.IOLoop.current().call_later(
+                self._interval, self._flush, state)
+
+    async def _send_pending(self, state, pending):
+        text = pending.get('text', state.text)
+        parse_mode = pending.get('parse_mode', state.parse_mode)
+        markup = pending['reply_markup']
+        markup = None if markup is None else util.encode_value(markup)
+        sent = (state.text, state.parse_mode, state.markup)
+        if (text, parse_mode, markup) == sent:
+            return
+
+        state.sent_at = time.monotonic()
+        try:
+            if 'text' in pending:
+                await self._client.edit_message_text(
+                    pending['text'], chat_id=state.chat_id,
+                    message_id=state.message_id,
+                    parse_mode=pending['parse_mode'],
+                    disable_web_page_preview=pending[
+                        'disable_web_page_preview'],
+                    reply_markup=pending['reply_markup'])
+            else:
+                await self._client.edit_message_reply_markup(
+                    chat_id=state.chat_id, message_id=state.message_id,
+                    reply_markup=pending['reply_markup'])
+        except BotError as e:
+            # the message already looks like this
+            if 'message is not modified' not in e.description:
+                raise
+        state.text = text
+        state.parse_mode = parse_mode
+        state.markup = markup
+
+
+class _MessageState(object):
+
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        # the last state sent, unknown until it is edited, so the first
+        # edit always goes out
+        self.text = _UNKNOWN
+        self.parse_mode = _UNKNOWN
+        self.markup = _UNKNOWN
+        self.sent_at = 0.0
+        self.pending = None
+        self.waiters = []
+        self.timer = None
+        self.sending = False
+
+    @property
+    def idle(self):
+        return not self.waiters and self.timer is None and not self.sending
+
+
+_UNKNOWN = object()
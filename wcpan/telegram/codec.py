@@ -0,0 +1,63 @@
+import json
+from typing import Any, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data: bytes) -> Any:
+    """
+    Decodes JSON from bytes or str. Raises ValueError for invalid input.
+    """
+    return _loads(data)
+
+
+def dumps(value: Any, default: Callable[[Any], Any] = None) -> bytes:
+    """
+    Encodes ``value`` as compact UTF-8 JSON. ``default`` converts objects
+    which are not JSON types, and raises TypeError for unsupported ones.
+    By default, objects with a ``to_dict`` method are encoded as its result.
+    """
+    if default is None:
+        default = to_dict_default
+    return _dumps(value, default)
+
+
+def to_dict_default(value: Any) -> Any:
+    # nested API objects, e.g. reply_markup inside a webhook reply
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError('{0!r} is not JSON serializable'.format(value))
+    return to_dict()
+
+
+def set_backend(name: str) -> None:
+    """
+    Selects the JSON library, ``orjson`` or ``json``. orjson is used by
+    default when it is installed.
+    """
+    global _loads, _dumps
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        _loads, _dumps = orjson.loads, _orjson_dumps
+    elif name == 'json':
+        _loads, _dumps = json.loads, _json_dumps
+    else:
+        raise ValueError('unknown JSON backend: {0}'.format(name))
+
+
+def _json_dumps(value, default):
+    return json.dumps(value, default=default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(value, default):
+    return orjson.dumps(value, default=default)
+
+
+_loads = None
+_dumps = None
+set_backend('json' if orjson is None else 'orjson')
@@ -0,0 +1,135 @@
+import collections
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from tornado import ioloop as ti, locks as tl
+
+from . import types
+
+
+_logger = logging.getLogger(__name__)
+
+
+Receiver = Callable[[types.Update], Awaitable[None]]
+
+
+class UpdateDispatcher(object):
+    """
+    Runs update handlers concurrently while keeping updates of the same chat
+    in order.
+
+    Each chat has its own queue, and at most ``max_workers`` chats are
+    handled at the same time. A failed handler is logged and does not stop
+    other updates.
+
+    At most ``max_pending`` updates are held in memory, ``put`` waits for
+    room beyond that. Zero means unbounded.
+    """
+
+    def __init__(self, max_workers: int = 16, max_pending: int = 1000) -> None:
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        self._chats = {}
+        self._ready = collections.deque()
+        self._workers = 0
+        self._pending = 0
+        self._high_water = 0
+        self._dispatched = 0
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+        self._total_lag = 0.0
+        self._not_full = tl.Condition()
+        self._idle = tl.Event()
+        self._idle.set()
+
+    @property
+    def stats(self) -> dict:
+        mean_lag = 0.0
+        if self._dispatched:
+            mean_lag = self._total_lag / self._dispatched
+        return {
+            'max_workers': self._max_workers,
+            'workers': self._workers,
+            'chats': len(self._chats),
+            'max_pending': self._max_pending,
+            'pending': self._pending,
+            'high_water': self._high_water,
+            'dispatched': self._dispatched,
+            'last_lag': self._last_lag,
+            'max_lag': self._max_lag,
+            'mean_lag': mean_lag,
+        }
+
+    @property
+    def full(self) -> bool:
+        return 0 < self._max_pending <= self._pending
+
+    async def put(self, update: types.Update,
+                  receive: Receiver) -> Awaitable[None]:
+        while self.full:
+            await self._not_full.wait()
+
+        key = _get_chat_key(update)
+        queue = self._chats.get(key, None)
+        if queue is None:
+            queue = collections.deque()
+            self._chats[key] = queue
+            self._ready.append(key)
+        queue.append((update, receive, time.monotonic()))
+        self._pending += 1
+        self._high_water = max(self._high_water, self._pending)
+        self._idle.clear()
+        self._spawn()
+
+    async def join(self) -> Awaitable[None]:
+        await self._idle.wait()
+
+    def _spawn(self):
+        loop = ti.IOLoop.current()
+        while self._ready and self._workers < self._max_workers:
+            key = self._ready.popleft()
+            self._workers += 1
+            loop.spawn_callback(self._work, key)
+
+    async def _work(self, key):
+        queue = self._chats[key]
+        update, receive, queued_at = queue.popleft()
+        lag = time.monotonic() - queued_at
+        self._dispatched += 1
+        self._last_lag = lag
+        self._max_lag = max(self._max_lag, lag)
+        self._total_lag += lag
+        try:
+            await receive(update)
+        except Exception:
+            _logger.exception('failed to handle update %d', update.update_id)
+        finally:
+            self._pending -= 1
+            self._workers -= 1
+            self._not_full.notify()
+            # give other chats a turn before handling the rest of this one
+            if queue:
+                self._ready.append(key)
+            else:
+                del self._chats[key]
+            self._spawn()
+            if not self._chats:
+                self._idle.set()
+
+
+def _get_chat_key(update: types.Update) -> Any:
+    data = update.to_dict()
+    for kind in ('message', 'edited_message', 'channel_post',
+                 'edited_channel_post'):
+        if kind in data:
+            return data[kind]['chat']['id']
+    if 'callback_query' in data:
+        data = data['callback_query']
+        if 'message' in data:
+            return data['message']['chat']['id']
+        return data['from']['id']
+    for kind in ('inline_query', 'chosen_inline_result'):
+        if kind in data:
+            return data[kind]['from']['id']
+    return None
@@ -0,0 +1,236 @@
+import collections
+import os
+import os.path as op
+import sqlite3
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from tornado import ioloop as ti, locks as tl
+
+from . import codec, types, util
+
+
+class OffsetStore(object):
+    """
+    Persists the last fully handled ``update_id``, and the updates after it
+    which were received but are not handled yet.
+
+    ``commit`` only records the state in memory. It is written out after
+    ``flush_interval`` seconds or after ``flush_every`` commits, whichever
+    comes first, so a busy bot does not sync to disk for every update.
+    """
+
+    def __init__(self, flush_interval: float = 1.0,
+                 flush_every: int = 100) -> None:
+        self._flush_interval = flush_interval
+        self._flush_every = flush_every
+        self._update_id = None
+        self._pending = {}
+        self._dirty = 0
+        self._timer = None
+        self._lock = tl.Lock()
+
+    async def load(self) -> Awaitable[Tuple[Optional[int], List[dict]]]:
+        update_id, pending = await util.run_in_executor(self._read)
+        self._update_id = update_id
+        return update_id, pending
+
+    def commit(self, update_id: int, pending: Dict[int, dict] = None) -> None:
+        # ``pending`` maps update ids to raw updates, it is copied on flush
+        self._update_id = update_id
+        if pending is not None:
+            self._pending = pending
+        self._dirty += 1
+        loop = ti.IOLoop.current()
+        if self._dirty >= self._flush_every:
+            loop.spawn_callback(self.flush)
+        elif self._timer is None:
+            self._timer = loop.call_later(self._flush_interval,
+                                          self._on_flush_timeout)
+
+    async def flush(self) -> Awaitable[None]:
+        if self._timer is not None:
+            ti.IOLoop.current().remove_timeout(self._timer)
+            self._timer = None
+        async with self._lock:
+            if not self._dirty or self._update_id is None:
+                return
+            self._dirty = 0
+            pending = [self._pending[_] for _ in sorted(self._pending)]
+            await util.run_in_executor(self._write, self._update_id, pending)
+
+    async def close(self) -> Awaitable[None]:
+        await self.flush()
+        await util.run_in_executor(self._close)
+
+    def _on_flush_timeout(self):
+        self._timer = None
+        ti.IOLoop.current().spawn_callback(self.flush)
+
+    def _read(self):
+        raise NotImplementedError()
+
+    def _write(self, update_id, pending):
+        raise NotImplementedError()
+
+    def _close(self):
+        pass
+
+
+class FileOffsetStore(OffsetStore):
+
+    def __init__(self, path: str, flush_interval: float = 1.0,
+                 flush_every: int = 100) -> None:
+        super(FileOffsetStore, self).__init__(flush_interval, flush_every)
+        self._path = path
+
+    def _read(self):
+        if not op.exists(self._path):
+            return None, []
+        with open(self._path, 'rb') as fin:
+            data = fin.read().strip()
+        if not data:
+            return None, []
+        data = codec.loads(data)
+        return data['update_id'], data['pending']
+
+    def _write(self, update_id, pending):
+        data = codec.dumps({
+            'update_id': update_id,
+            'pending': pending,
+        })
+        # replace the whole file so a crash never leaves a partial state
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, self._path)
+
+
+class SqliteOffsetStore(OffsetStore):
+
+    def __init__(self, path: str, name: str = 'default',
+                 flush_interval: float = 1.0, flush_every: int = 100) -> None:
+        super(SqliteOffsetStore, self).__init__(flush_interval, flush_every)
+        self._path = path
+        self._name = name
+        self._db = None
+
+    def _get_db(self):
+        if self._db is None:
+            # flushes are serialized, but may run on any executor thread
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            with self._db:
+                self._db.execute('''
+                    CREATE TABLE IF NOT EXISTS update_state (
+                        name TEXT PRIMARY KEY,
+                        update_id INTEGER NOT NULL,
+                        pending BLOB NOT NULL
+                    );
+                ''')
+        return self._db
+
+    def _read(self):
+        db = self._get_db()
+        row = db.execute('''
+            SELECT update_id, pending FROM update_state WHERE name = ?;
+        ''', (self._name,)).fetchone()
+        if row is None:
+            return None, []
+        return row[0], codec.loads(row[1])
+
+    def _write(self, update_id, pending):
+        db = self._get_db()
+        with db:
+            db.execute('''
+                INSERT OR REPLACE INTO update_state (name, update_id, pending)
+                VALUES (?, ?, ?);
+            ''', (self._name, update_id, codec.dumps(pending)))
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class OffsetTracker(object):
+    """
+    Tracks which queued updates are fully handled.
+
+    Updates can finish out of order, ``handled`` is the highest
+    ``update_id`` such that it and every update before it are done.
+    ``queued`` is the highest ``update_id`` received so far.
+
+    With a store, received updates are persisted until they are handled,
+    so the server can be told about them at once without losing them on a
+    crash.
+    """
+
+    def __init__(self, handled: int, store: OffsetStore = None) -> None:
+        self._handled = handled
+        self._queued = handled
+        self._store = store
+        self._pending = collections.deque()
+        self._updates = {}
+        self._done = set()
+        self._added = False
+
+    @property
+    def handled(self) -> int:
+        return self._handled
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    async def load(self) -> Awaitable[List[types.Update]]:
+        # returns updates which were received but not handled last time
+        if self._store is None:
+            return []
+        update_id, pending = await self._store.load()
+        if update_id is None:
+            return []
+        self._handled = update_id
+        self._queued = update_id
+        updates = [types.Update(_) for _ in pending]
+        return [_ for _ in updates if self.add(_)]
+
+    def add(self, update: types.Update) -> bool:
+        # the server may send an update again, skip it
+        update_id = update.update_id
+        if update_id <= self._queued:
+            return False
+        self._queued = update_id
+        self._pending.append(update_id)
+        if self._store is not None:
+            self._updates[update_id] = update.to_dict()
+            self._added = True
+        return True
+
+    async def flush(self) -> Awaitable[None]:
+        # received updates must be stored before the server forgets them
+        if not self._added:
+            return
+        self._added = False
+        self._store.commit(self._handled, self._updates)
+        await self._store.flush()
+
+    def done(self, update_id: int) -> None:
+        self._done.add(update_id)
+        while self._pending and self._pending[0] in self._done:
+            self._done.discard(self._pending.popleft())
+        self._handled = self._pending[0] - 1 if self._pending else self._queued
+        # also when it finished ahead of earlier updates, so it is not
+        # handled again after a restart
+        if self._updates.pop(update_id, None) is not None:
+            self._store.commit(self._handled, self._updates)
+
+    def wrap(self, receive: Callable[[types.Update], Awaitable[None]]
+             ) -> Callable[[types.Update], Awaitable[None]]:
+        async def receive_and_track(update):
+            try:
+                await receive(update)
+            finally:
+                self.done(update.update_id)
+        return receive_and_track
+
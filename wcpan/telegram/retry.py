@@ -0,0 +1,36 @@
+import random
+
+
+class RetryPolicy(object):
+    """
+    How a failed API call is retried.
+
+    Flood control waits exactly the ``retry_after`` sent by the server,
+    server errors and network failures back off exponentially with full
+    jitter. The call gives up after ``max_attempts`` attempts, or when the
+    next attempt would start after ``deadline`` seconds since the first one.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5,
+                 max_delay: float = 30.0, deadline: float = None) -> None:
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._deadline = deadline
+
+    @property
+    def deadline(self) -> float:
+        return self._deadline
+
+    def get_delay(self, attempt: int, retry_after: float = None) -> float:
+        if retry_after is not None:
+            return retry_after
+        delay = min(self._max_delay, self._base_delay * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    def allows(self, attempt: int, elapsed: float) -> bool:
+        if attempt >= self._max_attempts:
+            return False
+        if self._deadline is not None and elapsed >= self._deadline:
+            return False
+        return True
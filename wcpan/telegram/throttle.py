@@ -0,0 +1,172 @@
+import datetime
+import heapq
+import itertools
+import time
+from typing import Awaitable, Union
+
+from tornado import concurrent as tc, gen as tg, ioloop as ti
+
+
+# lower goes first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def try_consume(self) -> bool:
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def reserve(self) -> float:
+        # takes a token in advance, returns how long to wait for it
+        self._refill()
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+    def get_delay(self) -> float:
+        self._refill()
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+
+class RateLimiter(object):
+    """
+    Keeps outgoing messages under the limits of the Bot API.
+
+    Each chat has its own bucket, private chats (positive ids) allow
+    ``private_rate`` messages per second, groups and channels allow
+    ``group_rate``. A group may send a minute of its allowance at once, like
+    the 20 messages per minute of the server. All chats share one bucket of
+    ``global_rate``. A rate of None disables that limit.
+
+    When the shared bucket is empty, waiting calls are released by priority,
+    then in arrival order.
+    """
+
+    def __init__(self, global_rate: float = 30.0, private_rate: float = 1.0,
+                 group_rate: float = 20 / 60) -> None:
+        self._global = None
+        if global_rate:
+            self._global = TokenBucket(global_rate, global_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._chats = {}
+        self._sweep_size = _MIN_SWEEP_SIZE
+        self._waiters = []
+        self._counter = itertools.count()
+        self._timer = None
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'chats': len(self._chats),
+            'waiting': len(self._waiters),
+        }
+
+    async def acquire(self, chat_id: Union[int, str] = None,
+                      priority: int = PRIORITY_NORMAL, deadline: float = None
+                      ) -> Awaitable[None]:
+        """
+        ``deadline`` is a ``time.monotonic()`` value, raises
+        ``tornado.gen.TimeoutError`` if the message cannot be sent before it.
+        """
+        if chat_id is not None:
+            bucket = self._get_chat_bucket(chat_id)
+            if bucket is not None:
+                if deadline is not None:
+                    # do not take a token which cannot be used in time
+                    if time.monotonic() + bucket.get_delay() > deadline:
+                        raise tg.TimeoutError('Timeout')
+                delay = bucket.reserve()
+                if delay > 0:
+                    await tg.sleep(delay)
+
+        if self._global is None:
+            return
+        if not self._waiters and self._global.try_consume():
+            return
+        future = tc.Future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._wake_up()
+        if deadline is None:
+            await future
+            return
+        timeout = datetime.timedelta(
+            seconds=max(deadline - time.monotonic(), 0))
+        try:
+            await tg.with_timeout(timeout, future)
+        except tg.TimeoutError:
+            # leaves the queue, unless the token was just given
+            future.cancel()
+            raise
+
+    def _get_chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id, None)
+        if bucket is not None:
+            return bucket
+
+        private = isinstance(chat_id, int) and chat_id > 0
+        rate = self._private_rate if private else self._group_rate
+        if not rate:
+            return None
+        # groups may spend the allowance of a whole minute at once
+        capacity = 1 if private else max(1, rate * 60)
+
+        if len(self._chats) >= self._sweep_size:
+            self._sweep()
+        bucket = TokenBucket(rate, capacity)
+        self._chats[chat_id] = bucket
+        return bucket
+
+    def _sweep(self):
+        # a full bucket behaves the same as a new one
+        self._chats = {k: v for k, v in self._chats.items() if not v.idle}
+        self._sweep_size = max(_MIN_SWEEP_SIZE, len(self._chats) * 2)
+
+    def _wake_up(self):
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                # cancelled
+                heapq.heappop(self._waiters)
+                continue
+            if not self._global.try_consume():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+        if self._waiters and self._timer is None:
+            self._timer = ti.IOLoop.current().call_later(
+                self._global.get_delay(), self._on_timeout)
+
+    def _on_timeout(self):
+        self._timer = None
+        self._wake_up()
+
+
+_MIN_SWEEP_SIZE = 4096
@@ -0,0 +1,168 @@
+import datetime
+import heapq
+import importlib
+import itertools
+import time
+from typing import Awaitable
+
+from tornado import (concurrent as tc, gen as tg, httpclient as thc,
+                     simple_httpclient as ths)
+
+from .throttle import PRIORITY_NORMAL
+
+
+# the default of tornado's HTTP clients
+_DEFAULT_REQUEST_TIMEOUT = 20.0
+
+
+class Transport(object):
+    """
+    An HTTP connection pool owned by one bot.
+
+    ``max_clients`` caps concurrent requests, anything above it waits for a
+    free slot by priority, then in arrival order. Connections are only
+    reused by the curl backend, which is used by default if pycurl is
+    installed. The simple backend always opens a new connection per request.
+    """
+
+    def __init__(self, max_clients: int = 10, connect_timeout: float = None,
+                 request_timeout: float = None, keep_alive: bool = True,
+                 use_curl: bool = None) -> None:
+        if use_curl is None:
+            use_curl = _has_curl()
+        elif use_curl:
+            # fail early if pycurl is not available
+            importlib.import_module('tornado.curl_httpclient')
+        self._max_clients = max_clients
+        self._keep_alive = keep_alive
+        self._use_curl = use_curl
+        self._defaults = {}
+        if connect_timeout is not None:
+            self._defaults['connect_timeout'] = connect_timeout
+        if request_timeout is not None:
+            self._defaults['request_timeout'] = request_timeout
+        self._link = None
+        self._upload_link = None
+        self._active = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._requests = 0
+        self._errors = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'max_clients': self._max_clients,
+            'active': self._active,
+            'queued': len(self._waiters),
+            'requests': self._requests,
+            'errors': self._errors,
+        }
+
+    async def fetch(self, request: thc.HTTPRequest, raise_error: bool = True,
+                    priority: int = PRIORITY_NORMAL, deadline: float = None
+                    ) -> Awaitable[thc.HTTPResponse]:
+        """
+        ``deadline`` is a ``time.monotonic()`` value. Waiting for a slot past
+        it raises ``tornado.gen.TimeoutError``, and the request is aborted
+        when it is reached.
+        """
+        if not self._keep_alive:
+            request.headers['Connection'] = 'close'
+        link = self._get_link(request)
+
+        await self._acquire_slot(priority, deadline)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._release_slot()
+                raise tg.TimeoutError('Timeout')
+            # each attempt keeps its own timeout, so a hung attempt can
+            # still be retried before the deadline
+            timeout = request.request_timeout
+            if timeout is None:
+                timeout = self._defaults.get('request_timeout',
+                                             _DEFAULT_REQUEST_TIMEOUT)
+            # zero means no timeout
+            if timeout:
+                remaining = min(remaining, timeout)
+            request.request_timeout = remaining
+        self._requests += 1
+        try:
+            return await link.fetch(request, raise_error=raise_error)
+        except Exception:
+            self._errors += 1
+            raise
+        finally:
+            self._release_slot()
+
+    def close(self) -> None:
+        if self._link is not None:
+            self._link.close()
+            self._link = None
+        if self._upload_link is not None:
+            self._upload_link.close()
+            self._upload_link = None
+
+    async def _acquire_slot(self, priority, deadline):
+        if self._active < self._max_clients and not self._waiters:
+            self._active += 1
+            return
+        future = tc.Future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            if deadline is None:
+                await future
+            else:
+                await _wait_until(future, deadline)
+        except BaseException:
+            future.cancel()
+            # got the slot but cancelled before using it
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        # hand the slot over to the next waiter
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def _get_link(self, request):
+        # clients bind to the current IOLoop, so create them on first use
+        if self._link is None:
+            self._link = self._create_link(self._use_curl)
+        if request.body_producer is None:
+            return self._link
+        if isinstance(self._link, ths.SimpleAsyncHTTPClient):
+            return self._link
+        # curl does not support body_producer, stream uploads with the simple
+        # client instead
+        if self._upload_link is None:
+            self._upload_link = self._create_link(False)
+        return self._upload_link
+
+    def _create_link(self, use_curl):
+        if use_curl:
+            from tornado import curl_httpclient as thcc
+            class_ = thcc.CurlAsyncHTTPClient
+        else:
+            class_ = ths.SimpleAsyncHTTPClient
+        return class_(force_instance=True, max_clients=self._max_clients,
+                      defaults=self._defaults)
+
+
+def _has_curl():
+    try:
+        importlib.import_module('tornado.curl_httpclient')
+    except ImportError:
+        return False
+    return True
+
+
+def _wait_until(future, deadline):
+    timeout = datetime.timedelta(seconds=max(deadline - time.monotonic(), 0))
+    return tg.with_timeout(timeout, future)
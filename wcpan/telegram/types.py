@@ -1,6 +1,15 @@
-import json
+import mimetypes
+import os
 import os.path as op
-from typing import Optional, List
+from typing import (AsyncIterator, Awaitable, BinaryIO, Callable, Iterator,
+                    List, Optional, Union)
+
+from tornado import ioloop as ti
+
+from . import codec
+
+
+_CHUNK_SIZE = 524288
 
 
 class Update(object):
@@ -9,7 +18,10 @@ class Update(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
 
     @property
     def update_id(self) -> int:
@@ -84,7 +96,7 @@ class User(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def id_(self) -> int:
@@ -113,7 +125,7 @@ class Chat(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def id_(self) -> int:
@@ -150,7 +162,10 @@ class Message(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
 
     @property
     def message_id(self) -> int:
@@ -311,7 +326,7 @@ class MessageEntity(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def type_(self) -> str:
@@ -340,7 +355,7 @@ class PhotoSize(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -365,7 +380,7 @@ class Audio(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -398,7 +413,7 @@ class Document(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -427,7 +442,7 @@ class Video(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -464,7 +479,7 @@ class Voice(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -489,7 +504,7 @@ class VideoNote(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -518,7 +533,7 @@ class Contact(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def phone_number(self) -> str:
@@ -543,7 +558,7 @@ class Location(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def longitude(self) -> float:
@@ -560,7 +575,7 @@ class Venue(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def location(self) -> Location:
@@ -586,7 +601,7 @@ class UserProfilePhotos(object):
         self._photos = [[PhotoSize(ps) for ps in pss] for pss in data['photos']]
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     def __getitem__(self, item):
         return self._photos[item]
@@ -606,7 +621,7 @@ class File(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -638,7 +653,13 @@ class ReplyKeyboardMarkup(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
+
+    def freeze(self) -> 'FrozenMarkup':
+        return FrozenMarkup(self._data)
 
 
 class KeyboardButton(object):
@@ -656,7 +677,7 @@ class KeyboardButton(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     def to_dict(self):
         return self._data
@@ -673,7 +694,13 @@ class ReplyKeyboardRemove(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
+
+    def freeze(self) -> 'FrozenMarkup':
+        return FrozenMarkup(self._data)
 
 
 class InlineKeyboardMarkup(object):
@@ -686,11 +713,14 @@ class InlineKeyboardMarkup(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     def to_dict(self):
         return self._data
 
+    def freeze(self) -> 'FrozenMarkup':
+        return FrozenMarkup(self._data)
+
 
 class InlineKeyboardButton(object):
 
@@ -714,7 +744,7 @@ class InlineKeyboardButton(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     def to_dict(self):
         return self._data
@@ -726,7 +756,10 @@ class CallbackQuery(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
 
     @property
     def id_(self) -> str:
@@ -768,7 +801,41 @@ class ForceReply(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
+
+    def freeze(self) -> 'FrozenMarkup':
+        return FrozenMarkup(self._data)
+
+
+class FrozenMarkup(object):
+    """
+    An immutable reply markup from ``freeze()``. It is encoded once, and
+    every send reuses the encoded bytes.
+    """
+
+    def __init__(self, data: dict) -> None:
+        self._json = codec.dumps(data)
+
+    def __repr__(self) -> str:
+        return self._json.decode('utf-8')
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, FrozenMarkup):
+            return NotImplemented
+        return self._json == other._json
+
+    def __hash__(self) -> int:
+        return hash(self._json)
+
+    def to_dict(self):
+        # a new copy every time, so it cannot be changed
+        return codec.loads(self._json)
+
+    def to_json(self) -> bytes:
+        return self._json
 
 
 class ChatMember(object):
@@ -777,7 +844,7 @@ class ChatMember(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def user(self) -> User:
@@ -794,7 +861,7 @@ class ResponseParameters(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def migrate_to_chat_id(self) -> int:
@@ -806,29 +873,47 @@ class ResponseParameters(object):
 
 
 class InputFile(object):
+    """
+    A file to upload, read from ``file_path``.
+
+    The name, content type and size are computed once. ``write_to`` reads
+    the file in an executor, so large uploads do not block the IOLoop.
+    """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path: str, name: str = None,
+                 content_type: str = None) -> None:
         self._file_path = file_path
+        if name is None:
+            name = op.basename(file_path)
+        self._name = name
+        self._content_type = _guess_type(name, content_type)
+        self._size = None
 
     @property
-    def name(self):
-        return op.basename(self._file_path)
+    def name(self) -> str:
+        return self._name
 
     @property
-    def content_type(self):
-        import mimetypes
-        return mimetypes.guess_type(self._file_path)[0]
+    def content_type(self) -> Optional[str]:
+        return self._content_type
 
     @property
-    def content(self):
+    def content(self) -> bytes:
         with open(self._file_path, 'rb') as fin:
             return fin.read()
 
     @property
-    def size(self):
-        return op.getsize(self._file_path)
+    def size(self) -> Optional[int]:
+        if self._size is None:
+            self._size = op.getsize(self._file_path)
+        return self._size
+
+    @property
+    def reusable(self) -> bool:
+        # whether it can be read more than once, e.g. for retries
+        return True
 
-    def stream(self, chunk_size=524288):
+    def stream(self, chunk_size: int = _CHUNK_SIZE) -> Iterator[bytes]:
         with open(self._file_path, 'rb') as fin:
             while True:
                 chunk = fin.read(chunk_size)
@@ -836,6 +921,131 @@ class InputFile(object):
                     break
                 yield chunk
 
+    async def write_to(self, write: Callable[[bytes], Awaitable[None]],
+                       chunk_size: int = _CHUNK_SIZE) -> Awaitable[None]:
+        with open(self._file_path, 'rb') as fin:
+            await _pump(lambda: fin.read(chunk_size), write)
+
+
+class InputFileBytes(InputFile):
+    """
+    A file to upload from memory. ``data`` is not copied, chunks are slices
+    of it.
+    """
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview], name: str,
+                 content_type: str = None) -> None:
+        self._name = name
+        self._content_type = _guess_type(name, content_type)
+        self._view = memoryview(data).cast('B')
+        self._size = self._view.nbytes
+
+    @property
+    def content(self) -> bytes:
+        return self._view.tobytes()
+
+    def stream(self, chunk_size: int = _CHUNK_SIZE) -> Iterator[memoryview]:
+        for offset in range(0, self._size, chunk_size):
+            yield self._view[offset:offset + chunk_size]
+
+    async def write_to(self, write: Callable[[bytes], Awaitable[None]],
+                       chunk_size: int = _CHUNK_SIZE) -> Awaitable[None]:
+        for chunk in self.stream(chunk_size):
+            await write(chunk)
+
+
+class InputFileStream(InputFile):
+    """
+    A file to upload from a binary file object, read in an executor.
+
+    Unless ``size`` is given, it is the rest of the file if that can be
+    found out. A seekable file is read from its current position every
+    time, otherwise it can only be read once.
+    """
+
+    def __init__(self, fileobj: BinaryIO, name: str,
+                 content_type: str = None, size: int = None) -> None:
+        self._fileobj = fileobj
+        self._name = name
+        self._content_type = _guess_type(name, content_type)
+        self._start = _get_position(fileobj)
+        if size is None and self._start is not None:
+            size = _get_file_size(fileobj) - self._start
+        self._size = size
+        self._consumed = False
+
+    @property
+    def content(self) -> bytes:
+        self._rewind()
+        return self._fileobj.read()
+
+    @property
+    def size(self) -> Optional[int]:
+        return self._size
+
+    @property
+    def reusable(self) -> bool:
+        return self._start is not None
+
+    def stream(self, chunk_size: int = _CHUNK_SIZE) -> Iterator[bytes]:
+        self._rewind()
+        while True:
+            chunk = self._fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    async def write_to(self, write: Callable[[bytes], Awaitable[None]],
+                       chunk_size: int = _CHUNK_SIZE) -> Awaitable[None]:
+        self._rewind()
+        await _pump(lambda: self._fileobj.read(chunk_size), write)
+
+    def _rewind(self):
+        if self._start is not None:
+            self._fileobj.seek(self._start)
+        elif self._consumed:
+            raise TypeError('the file object can only be read once')
+        self._consumed = True
+
+
+class InputFileIterator(InputFile):
+    """
+    A file to upload from an async iterator of bytes, e.g. another
+    download. It can only be read once, and only by ``write_to``.
+    """
+
+    def __init__(self, iterator: AsyncIterator[bytes], name: str,
+                 content_type: str = None, size: int = None) -> None:
+        self._iterator = iterator
+        self._name = name
+        self._content_type = _guess_type(name, content_type)
+        self._size = size
+        self._consumed = False
+
+    @property
+    def content(self) -> bytes:
+        raise TypeError('an async iterator can only be read by write_to')
+
+    @property
+    def size(self) -> Optional[int]:
+        return self._size
+
+    @property
+    def reusable(self) -> bool:
+        return False
+
+    def stream(self, chunk_size: int = _CHUNK_SIZE) -> Iterator[bytes]:
+        raise TypeError('an async iterator can only be read by write_to')
+
+    async def write_to(self, write: Callable[[bytes], Awaitable[None]],
+                       chunk_size: int = _CHUNK_SIZE) -> Awaitable[None]:
+        if self._consumed:
+            raise TypeError('the iterator can only be read once')
+        self._consumed = True
+        # the iterator decides the chunk size
+        async for chunk in self._iterator:
+            await write(chunk)
+
 
 class Sticker(object):
 
@@ -843,7 +1053,7 @@ class Sticker(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -885,7 +1095,7 @@ class StickerSet(object):
         self._stickers = [Sticker(_) for _ in data['stickers']]
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def name(self) -> str:
@@ -909,6 +1119,12 @@ class MaskPosition(object):
     def __init__(self, data):
         self._data = data
 
+    def __repr__(self) -> str:
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
+
     @property
     def point(self) -> str:
         return self._data['point']
@@ -932,7 +1148,7 @@ class InlineQuery(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def id_(self) -> str:
@@ -964,7 +1180,10 @@ class InlineQueryResult(object):
         }
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
+
+    def to_dict(self):
+        return self._data
 
 
 class InlineQueryResultArticle(InlineQueryResult):
@@ -1477,7 +1696,7 @@ class InputMessageContent(object):
         self._data = {}
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     def to_dict(self):
         return self._data
@@ -1548,7 +1767,7 @@ class ChosenInlineResult(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def result_id(self) -> str:
@@ -1577,7 +1796,7 @@ class Game(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def title(self) -> str:
@@ -1615,7 +1834,7 @@ class Animation(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def file_id(self) -> str:
@@ -1649,7 +1868,7 @@ class GameHighScore(object):
         self._data = data
 
     def __repr__(self) -> str:
-        return json.dumps(self._data)
+        return _to_json(self._data)
 
     @property
     def position(self) -> int:
@@ -1670,3 +1889,53 @@ def _wrap_data(data, key, type_=None):
     if type_ is None:
         return data[key]
     return type_(data[key])
+
+
+def _to_json(data):
+    return codec.dumps(data).decode('utf-8')
+
+
+def _guess_type(name, content_type):
+    if content_type is not None:
+        return content_type
+    return mimetypes.guess_type(name)[0]
+
+
+def _get_position(fileobj):
+    try:
+        if not fileobj.seekable():
+            return None
+        return fileobj.tell()
+    except (AttributeError, OSError):
+        return None
+
+
+def _get_file_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError):
+        # not a real file, e.g. BytesIO
+        position = fileobj.tell()
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+        return size
+
+
+async def _pump(read, write):
+    # reads the next chunk in the executor while writing the current one
+    loop = ti.IOLoop.current()
+    pending = loop.run_in_executor(None, read)
+    try:
+        while True:
+            chunk = await pending
+            if not chunk:
+                break
+            pending = loop.run_in_executor(None, read)
+            await write(chunk)
+    finally:
+        # the file must stay open until the last read is done
+        if not pending.done():
+            try:
+                await pending
+            except Exception:
+                pass
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import os.path as op
+from typing import Awaitable, Optional
+
+from tornado import locks as tl
+
+from . import codec, types, util
+
+
+class UploadCache(object):
+    """
+    Remembers the ``file_id`` of uploaded files by their content.
+
+    Entries are keyed by the kind of the file, e.g. ``photo``, and the
+    SHA-256 digest of its content, because the same content sent as another
+    kind gets another ``file_id``. Subclasses decide where the table lives.
+    """
+
+    def __init__(self) -> None:
+        self._table = None
+        self._lock = tl.Lock()
+
+    async def get(self, kind: str, digest: str) -> Awaitable[Optional[str]]:
+        table = await self._load()
+        return table.get(_get_key(kind, digest), None)
+
+    async def set(self, kind: str, digest: str,
+                  file_id: str) -> Awaitable[None]:
+        table = await self._load()
+        table[_get_key(kind, digest)] = file_id
+        await self._save()
+
+    async def discard(self, kind: str, digest: str) -> Awaitable[None]:
+        table = await self._load()
+        if table.pop(_get_key(kind, digest), None) is not None:
+            await self._save()
+
+    async def _load(self):
+        async with self._lock:
+            if self._table is None:
+                self._table = await util.run_in_executor(self._read)
+        return self._table
+
+    async def _save(self):
+        async with self._lock:
+            await util.run_in_executor(self._write, dict(self._table))
+
+    def _read(self):
+        raise NotImplementedError()
+
+    def _write(self, table):
+        raise NotImplementedError()
+
+
+class MemoryUploadCache(UploadCache):
+
+    def __init__(self) -> None:
+        super(MemoryUploadCache, self).__init__()
+        self._table = {}
+
+    async def _save(self):
+        pass
+
+
+class FileUploadCache(UploadCache):
+    """
+    Keeps the table in a JSON file, so it survives restarts.
+    """
+
+    def __init__(self, path: str) -> None:
+        super(FileUploadCache, self).__init__()
+        self._path = path
+
+    def _read(self):
+        if not op.exists(self._path):
+            return {}
+        with open(self._path, 'rb') as fin:
+            return codec.loads(fin.read())
+
+    def _write(self, table):
+        # replace the whole file so a crash never leaves a partial table
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            fout.write(codec.dumps(table))
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_path, self._path)
+
+
+async def get_digest(input_file: types.InputFile) -> Awaitable[str]:
+    return await util.run_in_executor(_hash_input_file, input_file)
+
+
+def _hash_input_file(input_file):
+    hash_ = hashlib.sha256()
+    for chunk in input_file.stream():
+        hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _get_key(kind, digest):
+    return '{0}:{1}'.format(kind, digest)
+
@@ -1,4 +1,14 @@
-from . import types
+import binascii
+import os
+
+from tornado import ioloop as ti
+
+from . import codec, types
+
+
+_CRLF = b'\r\n'
+# files up to this size are copied into the surrounding headers
+_INLINE_SIZE = 65536
 
 
 def encode_multipart_formdata(fields):
@@ -8,7 +18,7 @@ def encode_multipart_formdata(fields):
     uploaded as files.
     Return (content_type, body) ready for httplib.HTTP instance
     """
-    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    BOUNDARY = _make_boundary().decode('ascii')
     CRLF = '\r\n'.encode('utf-8')
     L = []
     for (key, value) in fields:
@@ -31,51 +41,107 @@ def encode_multipart_formdata(fields):
 
 
 def generate_multipart_formdata(fields):
-    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    """
+    Returns (content_type, content_length, stream), content_length is None if
+    the size of a file is unknown. Headers and small fields between files
+    are written at once.
+    """
+    boundary = _make_boundary()
+    parts = []
+    buffer_ = bytearray()
+    for (key, value) in fields:
+        buffer_ += b'--' + boundary + _CRLF
+        if not isinstance(value, types.InputFile):
+            buffer_ += _to_bytes('Content-Disposition: form-data; name="%s"' % key) + _CRLF
+            buffer_ += _CRLF
+            buffer_ += _to_bytes(value) + _CRLF
+            continue
+        buffer_ += _to_bytes('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, value.name)) + _CRLF
+        buffer_ += _to_bytes('Content-Type: %s' % value.content_type) + _CRLF
+        if value.size is not None:
+            buffer_ += _to_bytes('Content-Length: %s' % value.size) + _CRLF
+        buffer_ += _CRLF
+        if isinstance(value, types.InputFileBytes) and value.size <= _INLINE_SIZE:
+            buffer_ += value.content
+        else:
+            parts.append(bytes(buffer_))
+            parts.append(value)
+            buffer_ = bytearray()
+        buffer_ += _CRLF
+    buffer_ += b'--' + boundary + b'--' + _CRLF
+    parts.append(bytes(buffer_))
+
+    content_length = 0
+    for part in parts:
+        if isinstance(part, bytes):
+            content_length += len(part)
+        elif part.size is None:
+            content_length = None
+            break
+        else:
+            content_length += part.size
 
     async def stream(write):
-        for (key, value) in fields:
-            if not isinstance(value, types.InputFile):
-                await _crlf_bytes(write, '--' + BOUNDARY)
-                await _crlf_bytes(write, 'Content-Disposition: form-data; name="%s"' % key)
-                await _crlf_bytes(write, '')
-                await _crlf_bytes(write, value)
+        for part in parts:
+            if isinstance(part, bytes):
+                await write(part)
             else:
-                await _crlf_bytes(write, '--' + BOUNDARY)
-                await _crlf_bytes(write, 'Content-Disposition: form-data; name="%s"; filename="%s"' % (key, value.name))
-                await _crlf_bytes(write, 'Content-Type: %s' % value.content_type)
-                await _crlf_bytes(write, 'Content-Length: %s' % value.size)
-                await _crlf_bytes(write, '')
-                for chunk in value.stream():
-                    await write(chunk)
-                await _crlf_bytes(write, '')
-        await _crlf_bytes(write, '--' + BOUNDARY + '--')
+                await part.write_to(write)
 
-    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
+    content_type = 'multipart/form-data; boundary=%s' % boundary.decode('ascii')
 
-    return content_type, stream
+    return content_type, content_length, stream
+
+
+def encode_json(args):
+    """
+    Encodes the arguments of an API call as a JSON object. Each value is
+    encoded on its own, so values which are already encoded are reused.
+    """
+    items = (codec.dumps(k) + b':' + encode_value(v) for k, v in args.items())
+    return b'{' + b','.join(items) + b'}'
+
+
+def encode_value(value):
+    # fast path for objects which keep their own encoding
+    to_json = getattr(value, 'to_json', None)
+    if to_json is not None:
+        return to_json()
+    return codec.dumps(value)
 
 
 def normalize_args(args):
+    # form fields of a multipart upload
+    return {k: _normalize_value(v) for k, v in args.items()}
+
+
+def _normalize_value(value):
     primitive_types = (bool, int, float, str, types.InputFile)
-    return {k: v if isinstance(v, primitive_types) else repr(v) for k, v in args.items()}
+    if isinstance(value, primitive_types):
+        return value
+    return encode_value(value)
+
+
+def run_in_executor(fn, *args):
+    return ti.IOLoop.current().run_in_executor(None, fn, *args)
 
 
 def _append_bytes(l, value):
     l.append(_to_bytes(value))
 
 
-async def _crlf_bytes(write, value):
-    b = _to_bytes(value) + '\r\n'.encode('utf-8')
-    await write(b)
+def _make_boundary():
+    # random, so it cannot appear in the content by accident
+    return b'----------' + binascii.hexlify(os.urandom(16))
 
 
 def _to_bytes(value):
     if isinstance(value, str):
         return value.encode('utf-8')
-    elif isinstance(value, (int, float)):
-        return str(value).encode('utf-8')
+    # bool is also an int
     elif isinstance(value, bool):
         return ('true' if value else 'false').encode('utf-8')
+    elif isinstance(value, (int, float)):
+        return str(value).encode('utf-8')
     else:
         return value